@@ -2,24 +2,31 @@
 from __future__ import annotations
 
 import argparse
-import json
+import codecs
 import re
 import sys
 import urllib.parse
-import urllib.request
-from html.parser import HTMLParser
 from pathlib import Path
 from typing import Optional
 
+import orjson
+from selectolax.lexbor import LexborHTMLParser
+
+from script_utils import fetch_html_head, make_pool_manager, normalize_for_match, save_json_atomic
+
 BOOKMARKS_PATH = Path("sites/polgarand.org/data/bookmarks.json")
 TIMEOUT_S = 15.0
 MAX_BYTES = 1_500_000
+CHARSET_SNIFF_BYTES = 1024
 USER_AGENT = "polgarand.org bookmark-fetcher/1.0"
+_WS_RE = re.compile(r"\s+")
+_META_CHARSET_RE = re.compile(rb"<meta[^>]+charset\s*=\s*[\"']?([\w.:-]+)", re.IGNORECASE)
+
+HTTP = make_pool_manager(timeout=TIMEOUT_S)
 
 
 def _clean_text(text: str) -> str:
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
+    return _WS_RE.sub(" ", text).strip()
 
 
 def _normalize_url(raw_url: str) -> str:
@@ -36,6 +43,32 @@ def _normalize_url(raw_url: str) -> str:
     return urllib.parse.urlunparse(normalized)
 
 
+def _content_charset(content_type: str) -> Optional[str]:
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.partition("=")
+        if key.strip().lower() == "charset":
+            return value.strip().strip("\"'") or None
+    return None
+
+
+def _sniff_charset(body: bytes) -> Optional[str]:
+    match = _META_CHARSET_RE.search(body, 0, CHARSET_SNIFF_BYTES)
+    if not match:
+        return None
+    charset = match.group(1).decode("ascii")
+    # A <meta> declaration can't be honest about UTF-16/32 (the tag itself was
+    # readable as ASCII), so follow the HTML spec's overrides.
+    if charset.lower() == "x-user-defined":
+        return "windows-1252"
+    try:
+        codec_name = codecs.lookup(charset).name
+    except LookupError:
+        return None
+    if codec_name.startswith(("utf-16", "utf-32")):
+        return "utf-8"
+    return charset
+
+
 def _fallback_title(url: str) -> str:
     parsed = urllib.parse.urlparse(url)
     host = parsed.netloc
@@ -50,106 +83,65 @@ def _fallback_description(url: str) -> str:
     return f"Bookmark for {parsed.netloc}"
 
 
-class _MetadataParser(HTMLParser):
-    def __init__(self) -> None:
-        super().__init__()
-        self._in_title = False
-        self._title_parts: list[str] = []
-        self.meta_title: Optional[str] = None
-        self.meta_description: Optional[str] = None
-        self.og_title: Optional[str] = None
-        self.og_description: Optional[str] = None
-        self.twitter_title: Optional[str] = None
-        self.twitter_description: Optional[str] = None
-
-    def handle_starttag(self, tag: str, attrs: list[tuple[str, Optional[str]]]) -> None:
-        tag = tag.lower()
-        if tag == "title":
-            self._in_title = True
-            return
-        if tag != "meta":
-            return
-
-        attr_map = {k.lower(): (v or "").strip() for k, v in attrs}
-        name = attr_map.get("name", "").lower()
-        prop = attr_map.get("property", "").lower()
-        content = _clean_text(attr_map.get("content", ""))
-        if not content:
-            return
-
-        if prop == "og:title":
-            self.og_title = content
-        elif prop == "og:description":
-            self.og_description = content
-        elif name == "twitter:title":
-            self.twitter_title = content
-        elif name == "twitter:description":
-            self.twitter_description = content
-        elif name == "description":
-            self.meta_description = content
-        elif name == "title":
-            self.meta_title = content
-
-    def handle_endtag(self, tag: str) -> None:
-        if tag.lower() == "title":
-            self._in_title = False
-
-    def handle_data(self, data: str) -> None:
-        if self._in_title:
-            self._title_parts.append(data)
-
-    def get_title(self) -> Optional[str]:
-        title_tag = _clean_text("".join(self._title_parts))
-        for value in (self.og_title, self.twitter_title, title_tag, self.meta_title):
-            if value:
-                return value
-        return None
+def _first_present(*values: Optional[str]) -> Optional[str]:
+    for value in values:
+        if value:
+            return value
+    return None
 
-    def get_description(self) -> Optional[str]:
-        for value in (self.og_description, self.twitter_description, self.meta_description):
-            if value:
-                return value
-        return None
+
+def _parse_metadata(html: str) -> tuple[Optional[str], Optional[str]]:
+    tree = LexborHTMLParser(html)
+    props: dict[str, str] = {}
+    names: dict[str, str] = {}
+    for node in tree.css("meta[content]"):
+        attrs = node.attributes
+        content = _clean_text(attrs.get("content") or "")
+        if not content:
+            continue
+        prop = (attrs.get("property") or "").strip().lower()
+        name = (attrs.get("name") or "").strip().lower()
+        if prop:
+            props[prop] = content
+        if name:
+            names[name] = content
+
+    title_node = tree.css_first("title")
+    title_tag = _clean_text(title_node.text()) if title_node is not None else ""
+    title = _first_present(props.get("og:title"), names.get("twitter:title"), title_tag, names.get("title"))
+    description = _first_present(
+        props.get("og:description"),
+        names.get("twitter:description"),
+        names.get("description"),
+    )
+    return title, description
 
 
 def _fetch_metadata(url: str) -> tuple[str, str]:
-    req = urllib.request.Request(
+    body, headers = fetch_html_head(
+        HTTP,
         url,
+        max_bytes=MAX_BYTES,
         headers={
             "User-Agent": USER_AGENT,
             "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
         },
     )
+    charset = (
+        _content_charset(headers.get("Content-Type", ""))
+        or _sniff_charset(body)
+        or "utf-8"
+    )
+    html = body.decode(charset, errors="replace")
 
-    with urllib.request.urlopen(req, timeout=TIMEOUT_S) as resp:
-        body = resp.read(MAX_BYTES + 1)
-        if len(body) > MAX_BYTES:
-            raise ValueError(f"response too large (> {MAX_BYTES} bytes)")
-        charset = resp.headers.get_content_charset() or "utf-8"
-        html = body.decode(charset, errors="replace")
-
-    parser = _MetadataParser()
-    parser.feed(html)
-    title = parser.get_title() or _fallback_title(url)
-    description = parser.get_description() or _fallback_description(url)
+    title, description = _parse_metadata(html)
+    title = title or _fallback_title(url)
+    description = description or _fallback_description(url)
     return title, description
 
 
-def _normalize_for_match(url: str) -> str:
-    parsed = urllib.parse.urlparse(url)
-    path = parsed.path.rstrip("/")
-    if not path:
-        path = "/"
-    normalized = parsed._replace(
-        scheme=parsed.scheme.lower(),
-        netloc=parsed.netloc.lower(),
-        path=path,
-        fragment="",
-    )
-    return urllib.parse.urlunparse(normalized)
-
-
-def _find_existing_index(bookmarks: list[dict], normalized_url: str) -> Optional[int]:
+def _build_url_index(bookmarks: list[dict]) -> dict[str, int]:
+    index: dict[str, int] = {}
     for idx, item in enumerate(bookmarks):
         if not isinstance(item, dict):
             continue
@@ -157,11 +149,10 @@ def _find_existing_index(bookmarks: list[dict], normalized_url: str) -> Optional
         if not isinstance(raw, str):
             continue
         try:
-            if _normalize_for_match(_normalize_url(raw)) == normalized_url:
-                return idx
+            index.setdefault(normalize_for_match(_normalize_url(raw)), idx)
         except ValueError:
             continue
-    return None
+    return index
 
 
 def _reorder_keys(item: dict) -> None:
@@ -179,10 +170,10 @@ def _reorder_keys(item: dict) -> None:
 
 def _load_bookmarks() -> list[dict]:
     try:
-        data = json.loads(BOOKMARKS_PATH.read_text(encoding="utf-8"))
+        data = orjson.loads(BOOKMARKS_PATH.read_bytes())
     except FileNotFoundError as exc:
         raise RuntimeError(f"input not found: {BOOKMARKS_PATH}") from exc
-    except json.JSONDecodeError as exc:
+    except orjson.JSONDecodeError as exc:
         raise RuntimeError(f"invalid json in {BOOKMARKS_PATH}: {exc}") from exc
 
     if not isinstance(data, list):
@@ -190,13 +181,6 @@ def _load_bookmarks() -> list[dict]:
     return data
 
 
-def _save_bookmarks(data: list[dict]) -> None:
-    BOOKMARKS_PATH.write_text(
-        json.dumps(data, indent=4, ensure_ascii=False) + "\n",
-        encoding="utf-8",
-    )
-
-
 def main() -> int:
     parser = argparse.ArgumentParser(
         description="Add or update a bookmark in sites/polgarand.org/data/bookmarks.json",
@@ -206,7 +190,7 @@ def main() -> int:
 
     try:
         normalized_url = _normalize_url(args.url)
-        normalized_for_match = _normalize_for_match(normalized_url)
+        normalized_for_match = normalize_for_match(normalized_url)
         data = _load_bookmarks()
     except (RuntimeError, ValueError) as exc:
         print(f"error: {exc}", file=sys.stderr)
@@ -219,7 +203,7 @@ def main() -> int:
         title = _fallback_title(normalized_url)
         description = _fallback_description(normalized_url)
 
-    existing_index = _find_existing_index(data, normalized_for_match)
+    existing_index = _build_url_index(data).get(normalized_for_match)
     if existing_index is None:
         entry: dict = {"url": normalized_url}
         data.insert(0, entry)
@@ -233,7 +217,7 @@ def main() -> int:
     entry["description"] = _clean_text(description)
     _reorder_keys(entry)
 
-    _save_bookmarks(data)
+    save_json_atomic(BOOKMARKS_PATH, data)
 
     print(f"{action}: {normalized_url}")
     print(f"title: {entry['title']}")
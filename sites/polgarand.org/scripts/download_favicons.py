@@ -6,36 +6,59 @@ from __future__ import annotations
 # `sites/polgarand.org/.favicons/` (gitignored) using the domain as the filename,
 # and write the resulting filename back onto each bookmark entry.
 
+import argparse
 import json
 import os
 import re
 import socket
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
 import urllib.error
 import urllib.parse
 import urllib.request
 from dataclasses import dataclass
-from html.parser import HTMLParser
 from pathlib import Path
-from typing import Optional
+from typing import NamedTuple, Optional
 
 import boto3
 import cairosvg
+import orjson
+import urllib3
 from botocore.exceptions import BotoCoreError, ClientError
 from dotenv import load_dotenv
 from PIL import Image, UnidentifiedImageError
+from selectolax.lexbor import LexborHTMLParser
+
+from script_utils import fetch_html_head, make_pool_manager, normalize_for_match, save_json_atomic
 
 BOOKMARKS_PATH = Path("sites/polgarand.org/data/bookmarks.json")
 OUT_DIR = Path("sites/polgarand.org/.favicons")
 DOTENV_PATH = Path("sites/polgarand.org/.env")
+FAVICON_CACHE_PATH = OUT_DIR / "_cache.json"
 
 TIMEOUT_S = 10.0
 MAX_BYTES = 1_000_000
+MAX_HTML_BYTES = 512_000
 USER_AGENT = "polgarand.org favicon-fetcher/1.0"
+MAX_WORKERS = 16
+MAX_CANDIDATE_WORKERS = 8
+FAVICON_CACHE_MAX_AGE_S = 14 * 24 * 60 * 60
 FAVICON_SIZE = (16, 16)
 R2_FAVICON_DIR = "favicons"
 CACHE_PURGE_PREFIX = "cdn.polgarand.org/favicons"
+_UNSAFE_DOMAIN_CHARS_RE = re.compile(r"[^a-z0-9.-]+")
+
+# One pool manager is shared by all worker threads (it is thread-safe), so
+# repeated requests to the same host reuse kept-alive connections.
+HTTP = make_pool_manager(
+    timeout=TIMEOUT_S,
+    num_pools=32,
+    maxsize=64,
+    headers={"User-Agent": USER_AGENT},
+)
 
 
 @dataclass(frozen=True)
@@ -56,11 +79,10 @@ def _safe_domain_filename(netloc: str) -> str:
     domain = netloc.split("@")[-1]
     domain = domain.split(":")[0]
     domain = domain.strip().lower()
-    return re.sub(r"[^a-z0-9.-]+", "_", domain).strip("._") or "unknown"
+    return _UNSAFE_DOMAIN_CHARS_RE.sub("_", domain).strip("._") or "unknown"
 
 
-@dataclass(frozen=True)
-class FaviconCandidate:
+class FaviconCandidate(NamedTuple):
     url: str
     priority: int
     size_area: Optional[int] = None
@@ -149,63 +171,147 @@ def _purge_favicon_cache(config: CloudflareConfig) -> None:
         raise ValueError(message or "Cloudflare rejected the cache purge")
 
 
-class _IconLinkParser(HTMLParser):
-    def __init__(self) -> None:
-        super().__init__()
-        self.candidates: list[FaviconCandidate] = []
+# Bookmarks often share a host, so the origin's <link rel="icon"> list is
+# reused across entries. `_favicon_cache` mirrors FAVICON_CACHE_PATH and maps
+# each domain key to the favicon last written for it, so siblings in this run
+# and later runs can skip the network.
+_origin_icon_cache: dict[str, list[FaviconCandidate]] = {}
+_favicon_cache: dict[str, dict] = {}
+# Guards the dicts above only; nothing holds it across a fetch. main() runs one
+# task per domain, so a domain (and the origins it falls back to) is never
+# fetched by two threads at once.
+_cache_lock = threading.Lock()
+# Set on Ctrl+C so workers stop starting new requests.
+_stop_requested = threading.Event()
 
-    @staticmethod
-    def _parse_size_area(value: str) -> Optional[int]:
-        sizes = (value or "").strip().lower()
-        if not sizes or sizes == "any":
-            return None
 
-        best: Optional[int] = None
-        for token in sizes.split():
-            if "x" not in token:
-                continue
-            left, right = token.split("x", 1)
-            try:
-                w = int(left)
-                h = int(right)
-            except ValueError:
-                continue
-            if w <= 0 or h <= 0:
-                continue
-            area = w * h
-            if best is None or area < best:
-                best = area
-        return best
-
-    def handle_starttag(self, tag: str, attrs: list[tuple[str, Optional[str]]]) -> None:
-        if tag.lower() != "link":
-            return
-        attr_map = {k.lower(): (v or "") for k, v in attrs}
-        rel = attr_map.get("rel", "").lower()
-        href = attr_map.get("href", "").strip()
-        size_area = self._parse_size_area(attr_map.get("sizes", ""))
-        if not href:
-            return
+def _load_favicon_cache() -> None:
+    try:
+        data = orjson.loads(FAVICON_CACHE_PATH.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return
+    if isinstance(data, dict):
+        _favicon_cache.update({k: v for k, v in data.items() if isinstance(v, dict)})
 
-        if "icon" not in rel:
-            return
 
-        priority = 100
-        if "shortcut" in rel:
-            priority = 90
-        if "apple-touch-icon" in rel:
-            priority = 80
-        self.candidates.append(FaviconCandidate(url=href, priority=priority, size_area=size_area))
+def _save_favicon_cache() -> None:
+    with _cache_lock:
+        data = dict(sorted(_favicon_cache.items()))
+    save_json_atomic(FAVICON_CACHE_PATH, data)
+
 
+def _parse_size_area(value: str) -> Optional[int]:
+    sizes = (value or "").strip().lower()
+    if not sizes or sizes == "any":
+        return None
+
+    best: Optional[int] = None
+    for token in sizes.split():
+        if "x" not in token:
+            continue
+        left, right = token.split("x", 1)
+        try:
+            w = int(left)
+            h = int(right)
+        except ValueError:
+            continue
+        if w <= 0 or h <= 0:
+            continue
+        area = w * h
+        if best is None or area < best:
+            best = area
+    return best
 
-def _http_get(url: str, *, max_bytes: int) -> tuple[bytes, str]:
-    req = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
-    with urllib.request.urlopen(req, timeout=TIMEOUT_S) as resp:
-        content_type = resp.headers.get("Content-Type", "")
+
+def _is_data_url(url: str) -> bool:
+    return url[:5].lower() == "data:"
+
+
+def _read_data_url(url: str, *, max_bytes: int) -> tuple[bytes, urllib3.HTTPHeaderDict]:
+    # Inline `data:` icons never touch the network; urllib's DataHandler decodes
+    # them (urllib3 only speaks HTTP).
+    try:
+        with urllib.request.urlopen(url) as resp:
+            body = resp.read(max_bytes + 1)
+            content_type = resp.headers.get("Content-Type", "")
+    except urllib.error.URLError as error:
+        raise ValueError(f"invalid data URL: {error.reason}") from error
+    if len(body) > max_bytes:
+        raise ValueError(f"data URL too large (> {max_bytes} bytes)")
+    return body, urllib3.HTTPHeaderDict({"Content-Type": content_type})
+
+
+def _http_get(url: str, *, max_bytes: int) -> tuple[bytes, urllib3.HTTPHeaderDict]:
+    if _is_data_url(url):
+        return _read_data_url(url, max_bytes=max_bytes)
+    resp = HTTP.request("GET", url, preload_content=False)
+    try:
         body = resp.read(max_bytes + 1)
         if len(body) > max_bytes:
+            resp.close()
             raise ValueError(f"response too large (> {max_bytes} bytes): {url}")
-        return body, content_type
+        if resp.status >= 400:
+            raise ValueError(f"HTTP {resp.status}: {url}")
+        return body, resp.headers
+    finally:
+        resp.release_conn()
+
+
+def _http_head(url: str) -> tuple[int, str, Optional[int]]:
+    resp = HTTP.request("HEAD", url)
+    length = resp.headers.get("Content-Length", "").strip()
+    return resp.status, resp.headers.get("Content-Type", ""), int(length) if length.isdigit() else None
+
+
+def _is_image_content_type(content_type: str) -> bool:
+    mime = (content_type.split(";", 1)[0] or "").strip().lower()
+    return not mime or mime.startswith("image/") or mime == "application/octet-stream"
+
+
+def _probe_candidate(url: str) -> bool:
+    if _is_data_url(url):
+        # Decoded locally by the GET, so there is nothing to probe.
+        return True
+    status, content_type, length = _http_head(url)
+    if status in (405, 501):
+        # The server rejects HEAD; let the GET decide.
+        return True
+    if status >= 400:
+        return False
+    if length is not None and (length == 0 or length > MAX_BYTES):
+        return False
+    return _is_image_content_type(content_type)
+
+
+def _is_unmodified(record: dict) -> bool:
+    url = record.get("url")
+    headers = {"User-Agent": USER_AGENT}
+    if record.get("etag"):
+        headers["If-None-Match"] = record["etag"]
+    if record.get("last_modified"):
+        headers["If-Modified-Since"] = record["last_modified"]
+    if not isinstance(url, str) or len(headers) == 1:
+        return False
+    try:
+        return HTTP.request("HEAD", url, headers=headers).status == 304
+    except urllib3.exceptions.HTTPError:
+        return False
+
+
+def _cached_favicon(record: dict) -> Optional[str]:
+    filename = record.get("filename")
+    if not isinstance(filename, str) or not (OUT_DIR / filename).exists():
+        return None
+
+    fetched_at = record.get("fetched_at")
+    if isinstance(fetched_at, (int, float)) and time.time() - fetched_at < FAVICON_CACHE_MAX_AGE_S:
+        return filename
+    if not _is_unmodified(record):
+        return None
+
+    with _cache_lock:
+        record["fetched_at"] = int(time.time())
+    return filename
 
 
 def _resize_raster_favicon(body: bytes) -> bytes:
@@ -233,24 +339,46 @@ def _resize_favicon(body: bytes) -> bytes:
 
 
 def _discover_icons_from_html(base_url: str, html: str) -> list[FaviconCandidate]:
-    parser = _IconLinkParser()
-    try:
-        parser.feed(html)
-    except Exception:
-        return []
-
     out: list[FaviconCandidate] = []
-    for c in parser.candidates:
+    for node in LexborHTMLParser(html).css('link[rel*="icon" i]'):
+        attrs = node.attributes
+        rel = (attrs.get("rel") or "").lower()
+        href = (attrs.get("href") or "").strip()
+        if not href:
+            continue
+
+        priority = 100
+        if "shortcut" in rel:
+            priority = 90
+        if "apple-touch-icon" in rel:
+            priority = 80
         out.append(
             FaviconCandidate(
-                url=urllib.parse.urljoin(base_url, c.url),
-                priority=c.priority,
-                size_area=c.size_area,
+                url=urllib.parse.urljoin(base_url, href),
+                priority=priority,
+                size_area=_parse_size_area(attrs.get("sizes") or ""),
             )
         )
     return out
 
 
+def _discover_origin_icons(origin: str) -> list[FaviconCandidate]:
+    with _cache_lock:
+        cached = _origin_icon_cache.get(origin)
+    if cached is not None:
+        return cached
+
+    try:
+        html_bytes, _headers = fetch_html_head(HTTP, origin, max_bytes=MAX_HTML_BYTES)
+        icons = _discover_icons_from_html(origin, html_bytes.decode("utf-8", errors="replace"))
+    except Exception:
+        icons = []
+
+    with _cache_lock:
+        _origin_icon_cache[origin] = icons
+    return icons
+
+
 def _default_candidates(page_url: str) -> list[FaviconCandidate]:
     parsed = urllib.parse.urlparse(page_url)
     origin = f"{parsed.scheme}://{parsed.netloc}"
@@ -264,55 +392,127 @@ def _default_candidates(page_url: str) -> list[FaviconCandidate]:
     ]
 
 
-def download_favicon(page_url: str) -> Optional[str]:
+def _save_favicon(domain_key: str, url: str) -> Optional[str]:
+    try:
+        body, headers = _http_get(url, max_bytes=MAX_BYTES)
+        if not _is_image_content_type(headers.get("Content-Type", "")):
+            return None
+        resized_body = _resize_favicon(body)
+    except (urllib3.exceptions.HTTPError, ValueError):
+        return None
+
+    out_path = OUT_DIR / f"{domain_key}.png"
+    for old in OUT_DIR.glob(f"{domain_key}.*"):
+        try:
+            old.unlink()
+        except OSError:
+            pass
+
+    out_path.write_bytes(resized_body)
+    with _cache_lock:
+        _favicon_cache[domain_key] = {
+            # An inline icon has no server to revalidate against.
+            "url": None if _is_data_url(url) else url,
+            "filename": out_path.name,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "fetched_at": int(time.time()),
+        }
+    return out_path.name
+
+
+def _candidate_sort_key(c: FaviconCandidate) -> tuple[int, int]:
+    size_area = c.size_area if c.size_area is not None else 2_147_483_647
+    return (-c.priority, size_area)
+
+
+def _dedupe_candidates(candidates: list[FaviconCandidate]) -> list[FaviconCandidate]:
+    # The default guesses and discovered <link> tags often name the same URL;
+    # keep only its best-ranked entry so each one is requested once.
+    best: dict[str, FaviconCandidate] = {}
+    for c in candidates:
+        key = normalize_for_match(c.url)
+        current = best.get(key)
+        if current is None or _candidate_sort_key(c) < _candidate_sort_key(current):
+            best[key] = c
+    return list(best.values())
+
+
+def download_favicon(page_url: str, *, use_cache: bool = True) -> Optional[str]:
     parsed = urllib.parse.urlparse(page_url)
     if not parsed.netloc:
         return None
     domain_key = _safe_domain_filename(parsed.netloc)
-    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    if use_cache:
+        with _cache_lock:
+            record = _favicon_cache.get(domain_key)
+        cached_name = _cached_favicon(record) if record is not None else None
+        if cached_name is not None:
+            return cached_name
+
+    if _stop_requested.is_set():
+        return None
 
     origin = f"{parsed.scheme}://{parsed.netloc}"
-    candidates: list[FaviconCandidate] = []
-    candidates.extend(_default_candidates(page_url))
-
+    # Most sites serve /favicon.ico, so try it before downloading any HTML.
+    favicon_ico = urllib.parse.urljoin(origin, "/favicon.ico")
     try:
-        html_bytes, _ct = _http_get(page_url, max_bytes=min(MAX_BYTES, 512_000))
-        candidates.extend(_discover_icons_from_html(page_url, html_bytes.decode("utf-8", errors="replace")))
-    except Exception:
+        if _probe_candidate(favicon_ico):
+            saved_name = _save_favicon(domain_key, favicon_ico)
+            if saved_name is not None:
+                return saved_name
+    except urllib3.exceptions.HTTPError:
         pass
 
+    if _stop_requested.is_set():
+        return None
+
+    candidates: list[FaviconCandidate] = []
+    candidates.extend(_default_candidates(page_url))
+
     if page_url.rstrip("/") != origin.rstrip("/"):
         try:
-            html_bytes, _ct = _http_get(origin, max_bytes=min(MAX_BYTES, 512_000))
-            candidates.extend(_discover_icons_from_html(origin, html_bytes.decode("utf-8", errors="replace")))
+            html_bytes, _headers = fetch_html_head(HTTP, page_url, max_bytes=MAX_HTML_BYTES)
+            candidates.extend(_discover_icons_from_html(page_url, html_bytes.decode("utf-8", errors="replace")))
         except Exception:
             pass
 
-    def candidate_sort_key(c: FaviconCandidate) -> tuple[int, int]:
-        size_area = c.size_area if c.size_area is not None else 2_147_483_647
-        return (-c.priority, size_area)
+    candidates.extend(_discover_origin_icons(origin))
 
-    for candidate in sorted(candidates, key=candidate_sort_key):
-        try:
-            body, content_type = _http_get(candidate.url, max_bytes=MAX_BYTES)
-            mime = (content_type.split(";", 1)[0] or "").strip().lower()
-            if mime and not mime.startswith("image/") and mime != "application/octet-stream":
+    tried = normalize_for_match(favicon_ico)
+    ordered = [c for c in _dedupe_candidates(candidates) if normalize_for_match(c.url) != tried]
+    ordered.sort(key=_candidate_sort_key)
+    if not ordered:
+        return None
+    # HEAD every candidate at once, then GET only the best-ranked survivors, so
+    # failing candidates cost a round-trip each instead of a full download.
+    pool = ThreadPoolExecutor(max_workers=min(len(ordered), MAX_CANDIDATE_WORKERS))
+    try:
+        probes = [pool.submit(_probe_candidate, c.url) for c in ordered]
+        for candidate, probe in zip(ordered, probes):
+            if _stop_requested.is_set():
+                return None
+            try:
+                if not probe.result():
+                    continue
+            except urllib3.exceptions.HTTPError:
                 continue
+            saved_name = _save_favicon(domain_key, candidate.url)
+            if saved_name is not None:
+                return saved_name
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
 
-            resized_body = _resize_favicon(body)
-            out_path = OUT_DIR / f"{domain_key}.png"
-
-            for old in OUT_DIR.glob(f"{domain_key}.*"):
-                try:
-                    old.unlink()
-                except OSError:
-                    pass
+    return None
 
-            out_path.write_bytes(resized_body)
-            return out_path.name
-        except (urllib.error.URLError, urllib.error.HTTPError, socket.timeout, TimeoutError, ValueError):
-            continue
 
+def _download_domain_favicon(page_urls: list[str], use_cache: bool) -> Optional[str]:
+    # Bookmarks on one domain share one output file, so a single task handles
+    # them all: the first page that yields a favicon decides it.
+    for page_url in page_urls:
+        filename = download_favicon(page_url, use_cache=use_cache)
+        if filename:
+            return filename
     return None
 
 
@@ -328,6 +528,22 @@ def _reorder_bookmark_item_keys(item: dict) -> None:
 
 
 def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Download favicons for sites/polgarand.org/data/bookmarks.json",
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--force",
+        action="store_true",
+        help="Re-download every favicon, ignoring existing files and the download cache",
+    )
+    mode.add_argument(
+        "--repair-missing",
+        action="store_true",
+        help="Also re-fetch bookmarks whose favicon file is missing from the output directory",
+    )
+    args = parser.parse_args()
+
     try:
         r2_config = _load_r2_config()
         cloudflare_config = _load_cloudflare_config()
@@ -336,11 +552,11 @@ def main() -> int:
         return 2
 
     try:
-        data = json.loads(BOOKMARKS_PATH.read_text(encoding="utf-8"))
+        data = orjson.loads(BOOKMARKS_PATH.read_bytes())
     except FileNotFoundError:
         print(f"error: input not found: {BOOKMARKS_PATH}", file=sys.stderr)
         return 2
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"error: invalid json in {BOOKMARKS_PATH}: {e}", file=sys.stderr)
         return 2
 
@@ -354,41 +570,69 @@ def main() -> int:
         if not isinstance(entry, dict):
             continue
         url = entry.get("url")
-        if isinstance(url, str) and url:
-            if "favicon" in entry:
+        if not isinstance(url, str) or not url:
+            continue
+        if not args.force and "favicon" in entry:
+            # Already has a favicon: skip without touching the network.
+            favicon = entry.get("favicon")
+            file_missing = not (isinstance(favicon, str) and favicon and (OUT_DIR / favicon).exists())
+            if not (args.repair_missing and file_missing):
                 skipped += 1
-            else:
-                entries.append(entry)
+                continue
+        entries.append(entry)
 
     total = len(entries)
-    print(f"bookmarks: {total} missing favicon, {skipped} skipped", flush=True)
+    print(f"bookmarks: {total} to fetch, {skipped} skipped", flush=True)
     ok = 0
     failed = 0
     updated = 0
     interrupted = False
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    # Load the cache even under --force: lookups are skipped then, but the
+    # records for domains this run doesn't touch must survive the save.
+    _load_favicon_cache()
+    groups: dict[str, list[dict]] = {}
+    for entry in entries:
+        domain_key = _safe_domain_filename(urllib.parse.urlparse(entry["url"]).netloc)
+        groups.setdefault(domain_key, []).append(entry)
+
+    # Fetching is network-bound, so overlap requests across domains. Results are
+    # consumed on this thread, which keeps the counters and entry updates serial.
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    futures = {
+        executor.submit(
+            _download_domain_favicon, [entry["url"] for entry in group], not args.force
+        ): group
+        for group in groups.values()
+    }
+    idx = 0
     try:
-        for idx, entry in enumerate(entries, start=1):
-            url = entry.get("url")
-            assert isinstance(url, str)
-            print(f"[{idx}/{total}] fetching favicon: {url}", flush=True)
-
-            filename = download_favicon(url)
-            if not filename:
-                failed += 1
-                print(f"[{idx}/{total}] fail", flush=True)
-                continue
-
-            ok += 1
-            if entry.get("favicon") != filename:
-                entry["favicon"] = filename
-                updated += 1
-            _reorder_bookmark_item_keys(entry)
-            print(f"[{idx}/{total}] ok: {filename}", flush=True)
+        for future in as_completed(futures):
+            filename = future.result()
+            for entry in futures[future]:
+                idx += 1
+                url = entry.get("url")
+                if not filename:
+                    failed += 1
+                    print(f"[{idx}/{total}] fail: {url}", flush=True)
+                    continue
+
+                ok += 1
+                if entry.get("favicon") != filename:
+                    entry["favicon"] = filename
+                    updated += 1
+                _reorder_bookmark_item_keys(entry)
+                print(f"[{idx}/{total}] ok: {filename} ({url})", flush=True)
     except KeyboardInterrupt:
         interrupted = True
+        _stop_requested.set()
+        executor.shutdown(wait=False, cancel_futures=True)
         print("\ninterrupted: writing partial updates...", flush=True)
+    else:
+        executor.shutdown()
 
-    BOOKMARKS_PATH.write_text(json.dumps(data, indent=4, ensure_ascii=False) + "\n", encoding="utf-8")
+    save_json_atomic(BOOKMARKS_PATH, data)
+    _save_favicon_cache()
     print(f"done: {ok} ok, {failed} failed, out_dir={OUT_DIR}")
     print(f"bookmarks: updated {updated} items (favicon field)")
     if interrupted:
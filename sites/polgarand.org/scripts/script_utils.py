@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+# Shared helpers for the polgarand.org bookmark scripts in this directory.
+
+import functools
+import json
+import os
+import re
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from typing import Optional
+
+import urllib3
+
+HTML_CHUNK_BYTES = 8192
+_HEAD_END_RE = re.compile(rb"</head\s*>", re.IGNORECASE)
+
+
+class _ProxyRoutingPoolManager(urllib3.PoolManager):
+    # Route each request the way urllib.request.urlopen would: through the
+    # proxy configured for its scheme, or direct when there is none or NO_PROXY
+    # matches the host. Redirects are followed here rather than inside a single
+    # manager, so every hop is routed on its own.
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        proxies = urllib.request.getproxies()
+        self._proxy_managers = {
+            scheme: urllib3.ProxyManager(proxies[scheme], **kwargs)
+            for scheme in ("http", "https")
+            if proxies.get(scheme)
+        }
+
+    def _proxy_for(self, url: str) -> Optional[urllib3.ProxyManager]:
+        parts = urllib.parse.urlsplit(url)
+        proxy = self._proxy_managers.get(parts.scheme.lower())
+        if proxy is None or urllib.request.proxy_bypass(parts.netloc):
+            return None
+        return proxy
+
+    def urlopen(self, method, url, redirect=True, **kw):
+        retries = kw.pop("retries", self.connection_pool_kw["retries"])
+        while True:
+            proxy = self._proxy_for(url)
+            if proxy is None:
+                response = super().urlopen(method, url, redirect=False, retries=retries, **kw)
+            else:
+                response = proxy.urlopen(method, url, redirect=False, retries=retries, **kw)
+            location = redirect and response.get_redirect_location()
+            if not location:
+                return response
+            if response.status == 303 and method != "HEAD":
+                method = "GET"
+            url = urllib.parse.urljoin(url, location)
+            response.drain_conn()
+            response.release_conn()
+            # Raises MaxRetryError once the redirect budget is spent.
+            retries = retries.increment(method, url, response=response)
+
+
+def make_pool_manager(*, timeout: float, **kwargs) -> urllib3.PoolManager:
+    # Mirror urllib.request.urlopen: no retries, up to 10 redirects, and the
+    # per-scheme HTTP_PROXY/HTTPS_PROXY/NO_PROXY settings from the environment.
+    retries = urllib3.Retry(total=None, connect=0, read=0, other=0, redirect=10)
+    return _ProxyRoutingPoolManager(timeout=timeout, retries=retries, **kwargs)
+
+
+def fetch_html_head(
+    http: urllib3.PoolManager,
+    url: str,
+    *,
+    max_bytes: int,
+    headers: Optional[dict[str, str]] = None,
+) -> tuple[bytes, urllib3.HTTPHeaderDict]:
+    # Titles, meta tags and icon links all live in <head>, so read only up to
+    # the first </head> (or `max_bytes`) and never download the body.
+    resp = http.request("GET", url, headers=headers, preload_content=False)
+    try:
+        if resp.status >= 400:
+            raise ValueError(f"HTTP {resp.status}: {url}")
+        html = bytearray()
+        scan_from = 0
+        while len(html) < max_bytes:
+            chunk = resp.read(min(HTML_CHUNK_BYTES, max_bytes - len(html)))
+            if not chunk:
+                break
+            html += chunk
+            match = _HEAD_END_RE.search(html, scan_from)
+            if match:
+                del html[match.end():]
+                break
+            # A "</head ... >" split across chunks must start at the last "<".
+            last_open = html.rfind(b"<", scan_from)
+            scan_from = last_open if last_open >= 0 else len(html)
+        return bytes(html), resp.headers
+    finally:
+        if not resp.closed:
+            # A connection with unread data can't go back to the pool.
+            resp.close()
+        resp.release_conn()
+
+
+def save_json_atomic(path: Path, data: object) -> None:
+    # Stream into a sibling file and swap it in, so an interrupted save never
+    # leaves a truncated file behind. The temp file sits next to `path` (the
+    # site's data/ directory is published as-is), so remove it on any failure.
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    try:
+        with tmp_path.open("w", encoding="utf-8") as fp:
+            json.dump(data, fp, indent=4, ensure_ascii=False)
+            fp.write("\n")
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_for_match(url: str) -> str:
+    # Comparison key for "is this the same URL": case-insensitive scheme and
+    # host, no trailing slash and no fragment.
+    parsed = urllib.parse.urlparse(url)
+    normalized = parsed._replace(
+        scheme=parsed.scheme.lower(),
+        netloc=parsed.netloc.lower(),
+        path=parsed.path.rstrip("/") or "/",
+        fragment="",
+    )
+    return urllib.parse.urlunparse(normalized)